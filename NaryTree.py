@@ -6,18 +6,106 @@ class MatchNode:
         self.children: dict[str, MatchNode] = {}
         self.values: set[str] = set()
 
+# values of shared nodes are frozensets; most nodes have none
+_NO_VALUES = frozenset()
+
+
+class NodeInterner:
+    """
+    Hash-conses MatchNodes so that structurally identical subtrees (same label,
+    values and children) are stored once. Interned nodes are shared and must not
+    be mutated (their values are frozensets); use merge() to combine them.
+    An interner only lives for one conversion or merge, so the lookup table is
+    freed with it and shared trees keep nothing but their live nodes.
+    """
+    def __init__(self):
+        self._table: dict[tuple, MatchNode] = {}
+        self._canonical: set[int] = set()
+        self._merged: dict[tuple[int, int], MatchNode] = {}
+
+    def make(self, label, values, children, node=None):
+        """
+        Return the shared node with this label, values and (already interned) children.
+        An existing immutable `node` with exactly these parts is adopted instead of copied.
+        """
+        if type(values) is not frozenset:
+            values = frozenset(values) if values else _NO_VALUES
+        key = (label, values, tuple(children), tuple(map(id, children.values())))
+        shared = self._table.get(key)
+        if shared is None:
+            if (node is not None and type(node.values) is frozenset
+                    and node.label == label and node.values == values
+                    and len(node.children) == len(children)
+                    and all(node.children.get(l) is c for l, c in children.items())):
+                shared = node
+            else:
+                shared = MatchNode(label)
+                shared.values = values
+                shared.children = children
+            self._table[key] = shared
+            self._canonical.add(id(shared))
+        return shared
+
+    def intern(self, node: MatchNode) -> MatchNode:
+        """Return the shared node equivalent to the subtree rooted at `node`."""
+        if id(node) in self._canonical:
+            return node
+        intern = self.intern
+        children = {label: intern(child) for label, child in node.children.items()}
+        return self.make(node.label, node.values, children, node)
+
+    def merge(self, target: MatchNode, source: MatchNode, merge_values=True) -> MatchNode:
+        """
+        Shared-form equivalent of combining `source` into `target`: children are
+        unioned by label and the values of matching nodes are merged.
+        """
+        target, source = self.intern(target), self.intern(source)
+        self._merged.clear()
+        return self._merge(target, source, merge_values)
+
+    def _merge(self, target, source, merge_values):
+        if target is source and merge_values:
+            return target
+        key = (id(target), id(source))
+        if key in self._merged:
+            return self._merged[key]
+        children = dict(target.children)
+        for label, s_child in source.children.items():
+            t_child = children.get(label)
+            children[label] = s_child if t_child is None else self._merge(t_child, s_child, True)
+        values = target.values | source.values if merge_values else target.values
+        node = self.make(target.label, values, children, target)
+        self._merged[key] = node
+        return node
+
+
 class NaryTree:
     def __init__(self, root="."):
         self.root = MatchNode(root)
+        # set when the tree is in hash-consed DAG form (see to_shared)
+        self.is_shared = False
+
+    def to_shared(self):
+        """Return a hash-consed DAG copy of the tree where identical subtrees are stored once."""
+        shared = NaryTree(self.root.label)
+        shared.root = NodeInterner().intern(self.root)
+        shared.is_shared = True
+        return shared
 
     def insert(self, fqdn: str, etldp1=None):
+        """Insert the tokens of `fqdn` and return the number of nodes created."""
+        if self.is_shared:
+            raise ValueError("cannot insert into a shared (DAG) tree")
         tokens = NaryTree.generate_tokens(fqdn, etldp1)
         node = self.root
+        created = 0
         for token in tokens:
             if token not in node.children:
                 node.children[token] = MatchNode(token)
+                created += 1
                 
             node = node.children[token]
+        return created
 
     def __str__(self):
         lines = []
@@ -34,7 +122,13 @@ class NaryTree:
         return "\n".join(lines)
     
     @staticmethod   
-    def tree_to_dict(node):
+    def tree_to_dict(node, _memo=None):
+        # shared (DAG) subtrees are converted once and referenced again
+        if _memo is None:
+            _memo = {}
+        if id(node) in _memo:
+            return _memo[id(node)]
+
         result = {}
 
         result['label'] = node.label
@@ -43,13 +137,27 @@ class NaryTree:
 
         if node.children:
             result['children'] = {
-                label: NaryTree.tree_to_dict(child)
+                label: NaryTree.tree_to_dict(child, _memo)
                 for label, child in node.children.items()
             }
 
+        _memo[id(node)] = result
         return result
 
 
+    @staticmethod
+    def dict_to_tree(data):
+        """Rebuild a NaryTree from the output of tree_to_dict (inverse of tree_to_dict)."""
+        def build(entry):
+            node = MatchNode(entry['label'])
+            node.values = set(entry.get('values', ()))
+            node.children = {label: build(child) for label, child in entry.get('children', {}).items()}
+            return node
+
+        tree = NaryTree()
+        tree.root = build(data)
+        return tree
+
     @staticmethod    
     def generate_tokens(fqdn: str, etldp1: str = None):
         """
@@ -9,39 +9,64 @@ Measures:
 3. Average-outward-metric 
 """
 
+def _memoized_dfs(visit):
+    """
+    Wrap a per-node recursion so each distinct node object is visited once.
+    Shared (hash-consed DAG) subtrees are then counted once per occurrence
+    without being re-traversed, giving the same numbers as the expanded tree.
+    """
+    memo = {}
+    def dfs(node):
+        key = id(node)
+        if key not in memo:
+            memo[key] = visit(node, dfs)
+        return memo[key]
+    return dfs
+
 def count_leaf_nodes(tree):
     """Count the number of leaf nodes in the tree."""
-    def dfs(node):
+    def visit(node, dfs):
         if not node.children:
             return 1
         return sum(dfs(child) for child in node.children.values())
-    return dfs(tree.root)
+    return _memoized_dfs(visit)(tree.root)
 
 def count_total_nodes(tree):
     """Count total number of nodes in the tree."""
-    def dfs(node):
+    def visit(node, dfs):
         count = 1
         for child in node.children.values():
             count += dfs(child)
         return count
-    return dfs(tree.root)
+    return _memoized_dfs(visit)(tree.root)
+
+def count_unique_nodes(tree):
+    """Count distinct node objects (smaller than count_total_nodes for shared trees)."""
+    seen = set()
+    stack = [tree.root]
+    while stack:
+        node = stack.pop()
+        if id(node) not in seen:
+            seen.add(id(node))
+            stack.extend(node.children.values())
+    return len(seen)
 
 def count_internal_nodes(tree):
     """Count internal nodes (nodes with at least one child)."""
-    def dfs(node):
+    def visit(node, dfs):
         if not node.children:
             return 0
         return 1 + sum(dfs(child) for child in node.children.values())
-    return dfs(tree.root)
+    return _memoized_dfs(visit)(tree.root)
 
 def total_branches(tree):
     """Count all branch edges (total children across internal nodes)."""
-    def dfs(node):
+    def visit(node, dfs):
         count = len(node.children)
         for child in node.children.values():
             count += dfs(child)
         return count
-    return dfs(tree.root)
+    return _memoized_dfs(visit)(tree.root)
 
 def branching_to_leaf_ratio(tree):
     """Compute ratio of total branches to number of leaves."""
@@ -51,20 +76,10 @@ def branching_to_leaf_ratio(tree):
 
 def average_out_degree(tree):
     """Compute the number of outward branches at each internal node and return the average"""
-    total_branches = 0
-    total_internal_nodes = 0
-
-    def dfs(node):
-        nonlocal total_branches, total_internal_nodes
-        if node.children:
-            total_branches += len(node.children)
-            total_internal_nodes += 1
-            for child in node.children.values():
-                dfs(child)
-
-    dfs(tree.root)
+    branches = total_branches(tree)
+    internal_nodes = count_internal_nodes(tree)
 
-    return total_branches / total_internal_nodes if total_internal_nodes > 0 else 0
+    return branches / internal_nodes if internal_nodes > 0 else 0
 
 
 def analyze_tree_complexity(tree):
@@ -2,12 +2,13 @@ import networkx as nx
 import seaborn as sns
 import matplotlib.pyplot as plt
 from collections import defaultdict
-import pandas as pd
 import argparse
 from NaryTree import (NaryTree, MatchNode)
 from difflib import get_close_matches
 import re
 from geoip_database import get_iso_country
+# re-exported: generate_mermaid_tree used to live here
+from tree_export import (generate_mermaid_tree, metrics_to_frame)
 # --- Build graph from tree ---
 
 def build_graph(node: MatchNode, graph: nx.DiGraph, parent_label=None):
@@ -33,34 +34,8 @@ def draw_tree(nray_tree: NaryTree):
     plt.tight_layout()
     plt.show()
 
-def generate_mermaid_tree(node, parent_label=None, lines=None, node_id=0, aggregated=False):
-    if lines is None:
-        lines = ["flowchart TD"]
-    node_values = list(node.values)
-    
-    if aggregated and node_values:
-        examples = ', '.join(node_values[:3])
-        node_label = f"{node.label} .i.e. {examples}".replace('"', "'")  # Escape quotes
-    else:
-        node_label = f"{node.label}".replace('"', "'")
-
-    current_id = f"n{node_id}"
-    lines.append(f'{current_id}["{node_label}"]')
-
-    if parent_label is not None:
-        lines.append(f"{parent_label} --> {current_id}")
-
-    this_id = current_id
-    child_id = node_id + 1
-
-    for child in node.children.values():
-        lines, child_id = generate_mermaid_tree(child, this_id, lines, child_id, aggregated=True)
-
-    return lines, child_id
-
 def plot_tree_metrics(metrics_dict):
-    df = pd.DataFrame(metrics_dict).T.reset_index()
-    df= df.rename(columns={"index": "etldp1"})
+    df = metrics_to_frame(metrics_dict)
     melted_df = df.melt(id_vars="etldp1", var_name="Metric", 
                         value_vars=["branching_to_leaf_ratio", "average_out_degree"])
 
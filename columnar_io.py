@@ -0,0 +1,193 @@
+import os
+import sys
+import tempfile
+import zlib
+import pandas as pd
+
+
+"""
+Columnar I/O:
+1. Reading pattern feeds from '|'-separated text, Parquet or Arrow (Feather) files
+2. Writing tables (e.g. tree complexity metrics) as CSV, Parquet or Arrow
+3. Streaming the flattened edge-list table of classified trees
+Parquet/Arrow support requires pyarrow.
+"""
+
+PATTERN_COLUMNS = ['patterntype', 'pattern', 'ip', 'etldp1', 'ipprefix', 'matchcount']
+# only these columns are used by the classification pipeline
+PATTERN_USED_COLUMNS = ['pattern', 'ip', 'etldp1']
+
+EDGE_COLUMNS = ['etldp1', 'node_id', 'parent_id', 'depth', 'parent', 'label', 'match_type', 'value_count']
+
+FORMATS = ["auto", "text", "parquet", "arrow"]
+
+
+def detect_format(path, fmt="auto"):
+    """Resolve 'auto' to a concrete format from the file extension."""
+    if fmt != "auto":
+        return fmt
+    if path and path.endswith(".parquet"):
+        return "parquet"
+    if path and path.endswith((".arrow", ".feather")):
+        return "arrow"
+    return "text"
+
+
+def _columnar_source(path, fmt):
+    # Parquet and Arrow files are read with seeks, which a pipe does not support
+    if path is None:
+        raise ValueError(f"{fmt} input cannot be read from stdin, pass a file path")
+    return path
+
+
+def read_patterns(source=None, fmt="auto"):
+    """
+    Read a pattern feed, projecting only the used columns and loading etldp1 as categorical.
+    `source` is a path, or None/'-' for stdin (text input only).
+    """
+    path = None if source in (None, "-") else source
+    fmt = detect_format(path, fmt)
+
+    if fmt == "parquet":
+        df = pd.read_parquet(_columnar_source(path, fmt), columns=PATTERN_USED_COLUMNS)
+    elif fmt == "arrow":
+        df = pd.read_feather(_columnar_source(path, fmt), columns=PATTERN_USED_COLUMNS)
+    else:
+        df = pd.read_csv(path or sys.stdin, sep='|', header=None, names=PATTERN_COLUMNS,
+                         usecols=PATTERN_USED_COLUMNS,
+                         dtype={'pattern': str, 'ip': str, 'etldp1': 'category'})
+
+    if df['etldp1'].dtype.name != 'category':
+        df['etldp1'] = df['etldp1'].astype('category')
+    return df
+
+
+def iter_pattern_chunks(source=None, fmt="auto", chunksize=100_000):
+    """Read a pattern feed in chunks of at most `chunksize` rows, projecting only the used columns."""
+    path = None if source in (None, "-") else source
+    fmt = detect_format(path, fmt)
+
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        batches = pq.ParquetFile(_columnar_source(path, fmt)).iter_batches(
+            batch_size=chunksize, columns=PATTERN_USED_COLUMNS)
+        for batch in batches:
+            yield batch.to_pandas()
+    elif fmt == "arrow":
+        import pyarrow as pa
+        reader = pa.ipc.open_file(_columnar_source(path, fmt))
+        for i in range(reader.num_record_batches):
+            yield reader.get_batch(i).select(PATTERN_USED_COLUMNS).to_pandas()
+    else:
+        yield from pd.read_csv(path or sys.stdin, sep='|', header=None, names=PATTERN_COLUMNS,
+                               usecols=PATTERN_USED_COLUMNS, dtype=str, chunksize=chunksize)
+
+
+def iter_etldp1_partitions(chunks, num_buckets=64, keep=None, spill_dir=None):
+    """
+    Yield (etldp1, rows) for each eTLD+1 of a chunked feed in any row order.
+    Rows are first spilled to `num_buckets` temporary files by a hash of etldp1, then
+    each bucket is read back and grouped on its own, so only one bucket's rows are held
+    in memory at a time. `keep` optionally selects the eTLD+1s to spill (e.g. a shard).
+    """
+    with tempfile.TemporaryDirectory(prefix="etldp1_buckets_", dir=spill_dir) as tmp:
+        paths = [os.path.join(tmp, f"{i}.csv") for i in range(num_buckets)]
+        spilled = set()
+        for chunk in chunks:
+            chunk = chunk[chunk['etldp1'].notna()]
+            # -1 marks eTLD+1s that are not kept
+            buckets = {
+                etldp1: zlib.crc32(etldp1.encode('utf-8')) % num_buckets if keep is None or keep(etldp1) else -1
+                for etldp1 in chunk['etldp1'].unique()
+            }
+            for i, rows in chunk.groupby(chunk['etldp1'].map(buckets), sort=False):
+                if i < 0:
+                    continue
+                rows.to_csv(paths[i], mode='a', sep='|', header=False, index=False,
+                            columns=PATTERN_USED_COLUMNS)
+                spilled.add(i)
+            del chunk
+
+        for i in sorted(spilled):
+            rows = pd.read_csv(paths[i], sep='|', header=None, names=PATTERN_USED_COLUMNS,
+                               dtype=str, keep_default_na=False, na_values=[''])
+            os.remove(paths[i])
+            for etldp1, group in rows.groupby('etldp1', sort=True):
+                yield etldp1, group
+            del rows
+
+
+def write_table(df, path, fmt="auto"):
+    """Write a DataFrame as CSV (keeping the index, like before), Parquet or Arrow."""
+    fmt = detect_format(path, fmt)
+    if fmt == "parquet":
+        df.to_parquet(path, index=False)
+    elif fmt == "arrow":
+        df.reset_index(drop=True).to_feather(path)
+    else:
+        df.to_csv(path)
+
+
+class EdgeTableWriter:
+    """
+    Incrementally write edge-list rows (see EDGE_COLUMNS) to CSV, Parquet or Arrow,
+    so trees can be appended one at a time.
+    """
+    def __init__(self, path, fmt="auto"):
+        self.path = path
+        self.fmt = detect_format(path, fmt)
+        self._writer = None
+        self._csv_started = False
+
+    @staticmethod
+    def _schema():
+        import pyarrow as pa
+        return pa.schema([
+            ('etldp1', pa.string()),
+            ('node_id', pa.int64()),
+            ('parent_id', pa.int64()),
+            ('depth', pa.int32()),
+            ('parent', pa.string()),
+            ('label', pa.string()),
+            ('match_type', pa.string()),
+            ('value_count', pa.int32()),
+        ])
+
+    def _open(self, schema):
+        if self.fmt == "parquet":
+            import pyarrow.parquet as pq
+            self._writer = pq.ParquetWriter(self.path, schema)
+        else:
+            import pyarrow as pa
+            self._writer = pa.ipc.new_file(self.path, schema)
+
+    def write(self, rows):
+        if not rows:
+            return
+        df = pd.DataFrame(rows, columns=EDGE_COLUMNS)
+        if self.fmt == "text":
+            df.to_csv(self.path, mode='a' if self._csv_started else 'w', header=not self._csv_started, index=False)
+            self._csv_started = True
+            return
+
+        import pyarrow as pa
+        schema = self._schema()
+        table = pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+        if self._writer is None:
+            self._open(schema)
+        self._writer.write_table(table)
+
+    def close(self):
+        if self.fmt == "text":
+            if not self._csv_started:
+                pd.DataFrame(columns=EDGE_COLUMNS).to_csv(self.path, index=False)
+            return
+        if self._writer is None:
+            self._open(self._schema())
+        self._writer.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -3,11 +3,26 @@ import geoip2.database
 import argparse
 from geoip2.errors import AddressNotFoundError
 from collections import defaultdict
+from functools import lru_cache
+from pipeline_profiler import profiler
 
 # Load the GeoLite2-City database once
 reader = geoip2.database.Reader("GeoLite2-Country.mmdb")
 
+# Patterns share many IPs, so lookups are memoized in a bounded LRU
+ISO_CACHE_SIZE = 65536
+
 def get_iso_country(ip: str) -> str:
+    if not profiler.enabled:
+        return _lookup_iso_country(ip)
+    hits = _lookup_iso_country.cache_info().hits
+    iso = _lookup_iso_country(ip)
+    profiler.count("geoip", "lookups")
+    profiler.count("geoip", "cache_hits", _lookup_iso_country.cache_info().hits - hits)
+    return iso
+
+@lru_cache(maxsize=ISO_CACHE_SIZE)
+def _lookup_iso_country(ip: str) -> str:
     try:
         #print("ip:", ip.split('/')[0].replace('.0','.10'))
         #response = reader.country(ip.split('/')[0].replace('.0','.10'))
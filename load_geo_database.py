@@ -1,6 +1,12 @@
+import os
+import queue
 import sqlite3
+import threading
+from contextlib import contextmanager
 from collections import defaultdict
+from urllib.request import pathname2url
 from NaryTree import (NaryTree, MatchNode)
+from pipeline_profiler import profiler
 
 
 def connect_geo_db(db_path="geo_name_un_locode.db"):
@@ -8,26 +14,100 @@ def connect_geo_db(db_path="geo_name_un_locode.db"):
     return sqlite3.connect(db_path)
 
 
-def load_geo_names(cursor, country_iso):
+def connect_geo_db_readonly(db_path="geo_name_un_locode.db", immutable=False,
+                            mmap_size=256 * 1024 * 1024, cache_size_kib=64 * 1024):
     """
-    Load GeoNames entries for a given country code.
-    Returns a list of dicts with name, ascii, and alternates set.
+    Open the geo database through a read-only URI (immutable=1 additionally skips
+    locking and change detection; only use it when the file cannot change).
+    The connection may be used from other threads, one at a time.
+    """
+    uri = f"file:{pathname2url(os.path.abspath(db_path))}?mode=ro"
+    if immutable:
+        uri += "&immutable=1"
+    conn = sqlite3.connect(uri, uri=True, check_same_thread=False)
+    conn.execute(f"PRAGMA mmap_size = {int(mmap_size)};")
+    # negative cache_size is in KiB rather than pages
+    conn.execute(f"PRAGMA cache_size = -{int(cache_size_kib)};")
+    conn.execute("PRAGMA query_only = ON;")
+    return conn
+
+
+class GeoDBPool:
+    """
+    Thread-safe pool of read-only geo database connections.
+    Connections are opened lazily, up to `size`, and handed out by connection().
+    """
+    def __init__(self, db_path="geo_name_un_locode.db", size=4, **connect_kwargs):
+        self.db_path = db_path
+        self.size = max(1, size)
+        self.connect_kwargs = connect_kwargs
+        self._idle = queue.LifoQueue()
+        self._opened = []
+        self._lock = threading.Lock()
+
+    def _acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if len(self._opened) < self.size:
+                conn = connect_geo_db_readonly(self.db_path, **self.connect_kwargs)
+                self._opened.append(conn)
+                return conn
+        return self._idle.get()
+
+    @contextmanager
+    def connection(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._idle.put(conn)
+
+    def close(self):
+        with self._lock:
+            for conn in self._opened:
+                conn.close()
+            self._opened = []
+        self._idle = queue.LifoQueue()
+
+
+def iter_rows(cursor, loader, query, params=()):
+    """Run `query` and yield rows straight from the cursor, counting queries and rows per loader."""
+    cursor.execute(query, params)
+    profiler.count("sqlite_queries", loader)
+    rows = 0
+    for row in cursor:
+        rows += 1
+        yield row
+    profiler.count("sqlite_rows_fetched", loader, rows)
+
+
+def iter_geo_names(cursor, country_iso):
     """
-    cursor.execute("""
+    Yield GeoNames entries for a given country code, one dict at a time,
+    with name, ascii, and alternates set.
+    """
+    for name, ascii_name, alternates in iter_rows(cursor, "geo_names", """
         SELECT name, ascii_name, alternate_names 
         FROM geo_names 
         WHERE country_code = ?;
-    """, (country_iso,))
-    
-    results = []
-    for name, ascii_name, alternates in cursor.fetchall():
+    """, (country_iso,)):
         alt_set = set(a.strip().lower() for a in alternates.split(',') if a.strip()) if alternates else set()
-        results.append({
+        yield {
             'name': name.lower(),
             'ascii': ascii_name.lower(),
             'alternates': alt_set
-        })
-    return results
+        }
+
+
+def load_geo_names(cursor, country_iso):
+    """
+    Load GeoNames entries for a given country code.
+    Returns a list of dicts with name, ascii, and alternates set.
+    """
+    return list(iter_geo_names(cursor, country_iso))
 
 
 def load_un_locode(cursor, country_iso):
@@ -35,50 +115,72 @@ def load_un_locode(cursor, country_iso):
     Load UN LOCODE city-level data for a given country.
     Returns a list of dicts.
     """
-    cursor.execute("""
+    rows = iter_rows(cursor, "un_locode", """
         SELECT locode, name, ascii_name 
         FROM un_locode 
         WHERE country_code = ?;
     """, (country_iso,))
-    
     return [
         {
             'locode': row[0].strip().lower(),
             'name': row[1].strip().lower(),
             'ascii': row[2].strip().lower()
         }
-        for row in cursor.fetchall()
+        for row in rows
     ]
 
 
+def load_un_locode_codes(cursor, country_iso):
+    """
+    Load the UN LOCODE location codes for a given country.
+    Returns a flat set of lowercase codes.
+    """
+    return set(row[0].strip().lower() for row in iter_rows(cursor, "un_locode", """
+        SELECT locode 
+        FROM un_locode 
+        WHERE country_code = ?;
+    """, (country_iso,)))
+
+
 def load_un_locode_subdiv(cursor, country_iso):
     """
     Load UN LOCODE subdivision-level data for a given country.
     Returns a list of dicts.
     """
-    cursor.execute("""
+    rows = iter_rows(cursor, "un_locode_subdiv", """
         SELECT code, name, type 
         FROM un_locode_subdiv 
         WHERE country_code = ?;
     """, (country_iso,))
-    
     return [
         {
             'code': row[0].strip().lower(),
             'name': row[1].strip().lower(),
             'type': row[2].strip().lower()
         }
-        for row in cursor.fetchall()
+        for row in rows
     ]
 
 
+def load_un_locode_subdiv_codes(cursor, country_iso):
+    """
+    Load the UN LOCODE subdivision codes for a given country.
+    Returns a flat set of lowercase codes.
+    """
+    return set(row[0].strip().lower() for row in iter_rows(cursor, "un_locode_subdiv", """
+        SELECT code 
+        FROM un_locode_subdiv 
+        WHERE country_code = ?;
+    """, (country_iso,)))
+
+
 def load_directional_terms(cursor):
     """
     Load global directional/region terms (e.g., 'east', 'central').
     Returns a flat set of lowercase terms.
     """
-    cursor.execute("SELECT term FROM directional_terms;")
-    return set(row[0].strip().lower() for row in cursor.fetchall())
+    rows = iter_rows(cursor, "directional_terms", "SELECT term FROM directional_terms;")
+    return set(row[0].strip().lower() for row in rows)
 
 
 def load_geo_classification_terms(cursor):
@@ -86,8 +188,8 @@ def load_geo_classification_terms(cursor):
     Load general geo-classification terms (e.g., 'afnic', 'apnic', 'atlantic').
     Returns a flat set of lowercase keywords.
     """
-    cursor.execute("SELECT keyword FROM geo_classification_terms;")
-    return set(row[0].strip().lower() for row in cursor.fetchall())
+    rows = iter_rows(cursor, "geo_classification_terms", "SELECT keyword FROM geo_classification_terms;")
+    return set(row[0].strip().lower() for row in rows)
 
 if __name__ == "__main__":
     conn = connect_geo_db()
@@ -0,0 +1,122 @@
+import argparse
+import gzip
+import json
+import os
+import tempfile
+import zlib
+from collections import Counter
+
+from NaryTree import NaryTree
+from columnar_io import write_table
+from tree_export import (combine_trees, metrics_to_frame, TreeExporter)
+
+
+"""
+Merge the partial outputs written by `token_matching.py --shard i/N --shard-output ...`.
+Trees of the same eTLD+1 found in several partials are combined with combine_trees
+semantics and only their metrics are recomputed; all other metrics are reused.
+A first pass indexes the eTLD+1s of every partial. Trees found in a single partial
+are then exported as they are read; the others are spilled to hash bucket files and
+combined one bucket at a time, so only a bucket's trees are held in memory.
+"""
+
+def read_partial(path):
+    """Yield the header and then one {etldp1, tree, metrics} entry per line of a partial output."""
+    with gzip.open(path, 'rt', encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def index_partials(paths):
+    """
+    Check that the partials were produced with the same options and count the
+    partials each eTLD+1 appears in; returns the options and the counts.
+    """
+    options, counts = None, Counter()
+    for path in paths:
+        entries = read_partial(path)
+        header = next(entries, None)
+        if header is None:
+            raise ValueError(f"empty partial output: {path}")
+        shard_options = {"graph": header["graph"], "digits": header["digits"]}
+        if options is None:
+            options = shard_options
+        elif shard_options != options:
+            raise ValueError(f"{path} was produced with {shard_options}, expected {options}")
+        counts.update(entry["etldp1"] for entry in entries)
+    return options or {"graph": "normal", "digits": False}, counts
+
+
+def merge_partials(paths, counts, num_buckets=64, spill_dir=None):
+    """
+    Yield (etldp1, tree, metrics) for every eTLD+1 of the partials, one at a time;
+    metrics is None for trees combined from several partials (see index_partials).
+    """
+    with tempfile.TemporaryDirectory(prefix="merge_buckets_", dir=spill_dir) as tmp:
+        buckets = {}
+        try:
+            for path in paths:
+                entries = read_partial(path)
+                next(entries)
+                for entry in entries:
+                    etldp1 = entry["etldp1"]
+                    if counts[etldp1] == 1:
+                        yield etldp1, NaryTree.dict_to_tree(entry["tree"]), entry["metrics"]
+                        continue
+                    i = zlib.crc32(etldp1.encode('utf-8')) % num_buckets
+                    if i not in buckets:
+                        buckets[i] = open(os.path.join(tmp, f"{i}.jsonl"), 'w', encoding='utf-8')
+                    buckets[i].write(json.dumps(entry) + "\n")
+        finally:
+            for f in buckets.values():
+                f.close()
+
+        for i in sorted(buckets):
+            path = os.path.join(tmp, f"{i}.jsonl")
+            trees = {}
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    entry = json.loads(line)
+                    tree = NaryTree.dict_to_tree(entry["tree"])
+                    etldp1 = entry["etldp1"]
+                    trees[etldp1] = combine_trees(trees[etldp1], tree) if etldp1 in trees else tree
+            os.remove(path)
+            for etldp1 in sorted(trees):
+                yield etldp1, trees.pop(etldp1), None
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge sharded partial trees and metrics")
+    parser.add_argument("partials", nargs='+', help="Partial outputs written with --shard-output")
+    parser.add_argument("--export-json", type=str, help="Export all merged plucked trees as JSON files")
+    parser.add_argument("--export-metrics", type=str, help="Path to save tree complexity metrics as CSV, .parquet or .arrow")
+    parser.add_argument("--export-edges", type=str, help="Path to save a flattened edge list of all merged trees as CSV, .parquet or .arrow")
+    parser.add_argument("--buckets", type=int, default=64, help="Number of bucket files trees found in several partials are spilled to")
+    parser.add_argument("--spill-dir", type=str, help="Directory for the bucket files (default: the system temp directory)")
+    args = parser.parse_args()
+
+    options, counts = index_partials(args.partials)
+    export_args = argparse.Namespace(
+        graph=options["graph"], digits=options["digits"], shared_dag=False,
+        export_json=args.export_json, export_edges=args.export_edges,
+        shard=None, shard_output=None,
+    )
+
+    exporter = TreeExporter(export_args)
+    try:
+        merged = 0
+        for etldp1, tree, metrics in merge_partials(args.partials, counts, args.buckets, args.spill_dir):
+            if metrics is None:
+                merged += 1
+            exporter.export(etldp1, tree, metrics=metrics)
+    finally:
+        exporter.close()
+
+    metrics_df = metrics_to_frame(exporter.tree_complexity_metrics)
+    print(f"merged {len(counts)} trees from {len(args.partials)} partials ({merged} combined across partials)")
+    if args.export_metrics:
+        write_table(metrics_df, args.export_metrics)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+
+"""
+Pipeline Profiler:
+Collects lightweight instrumentation for a classification run:
+1. Wall and CPU time per pipeline stage
+2. SQLite queries and rows fetched per gazetteer loader
+3. GeoIP lookups and cache hits
+4. Nodes created per tree
+5. Matcher hit rates per MATCHERS type
+Counters are no-ops until the profiler is enabled (token_matching.py --profile).
+Stage CPU time is the CPU time of the calling thread. Stages run by several worker
+threads (-j) are summed over those threads, so their wall and CPU totals measure
+work done and can exceed the wall time of the enclosing stage.
+"""
+
+
+class PipelineProfiler:
+    def __init__(self):
+        self.enabled = False
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.stages = defaultdict(lambda: {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0})
+        self.counters = defaultdict(lambda: defaultdict(int))
+
+    @contextmanager
+    def stage(self, name):
+        """Accumulate wall and CPU time spent inside the block under `name`."""
+        if not self.enabled:
+            yield
+            return
+        wall_start, cpu_start = time.perf_counter(), time.thread_time()
+        try:
+            yield
+        finally:
+            wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+            with self._lock:
+                entry = self.stages[name]
+                entry["calls"] += 1
+                entry["wall_s"] += wall
+                entry["cpu_s"] += cpu
+
+    def count(self, group, key, n=1):
+        """Add `n` to the counter `group`/`key`."""
+        if not self.enabled:
+            return
+        with self._lock:
+            self.counters[group][key] += n
+
+    def matcher_hit_rates(self):
+        """Matched tokens over checked tokens for every matcher type."""
+        checked = self.counters.get("matcher_tokens_checked", {})
+        matched = self.counters.get("matcher_tokens_matched", {})
+        return {
+            match_type: matched.get(match_type, 0) / total if total else 0
+            for match_type, total in checked.items()
+        }
+
+    def report(self):
+        """Return the collected instrumentation as a JSON-serializable dict."""
+        with self._lock:
+            report = {
+                "stages": {name: dict(entry) for name, entry in self.stages.items()},
+                "counters": {group: dict(values) for group, values in self.counters.items()},
+            }
+        report["matcher_hit_rates"] = self.matcher_hit_rates()
+        return report
+
+    def write_report(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.report(), f, indent=2)
+
+
+# Shared instance used by all pipeline modules
+profiler = PipelineProfiler()
+
+
+@contextmanager
+def profile_dump(kind, path):
+    """
+    Optionally wrap a run in cProfile ("cprofile") or tracemalloc ("tracemalloc")
+    and dump the result to `path`. Does nothing when `kind` is None.
+    """
+    if kind == "cprofile":
+        import cProfile
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            yield
+        finally:
+            prof.disable()
+            prof.dump_stats(path)
+    elif kind == "tracemalloc":
+        import tracemalloc
+        tracemalloc.start()
+        try:
+            yield
+        finally:
+            snapshot = tracemalloc.take_snapshot()
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            with open(path, 'w') as f:
+                f.write(f"current: {current} bytes, peak: {peak} bytes\n")
+                for stat in snapshot.statistics('lineno')[:50]:
+                    f.write(f"{stat}\n")
+    else:
+        yield
@@ -0,0 +1,118 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+from pipeline_profiler import profiler
+
+
+"""
+Token Classification Cache:
+A classification only depends on the matcher, the token text, the country and the
+gazetteer version, so results are persisted in a SQLite store, one slice per
+(matcher, country_iso, gazetteer_version) with a row per token (NULL records a no-match).
+Country-independent matchers are stored under an empty country_iso. A slice is loaded
+into memory with a single query the first time it is needed; an LRU bounds the slices kept.
+"""
+
+schema = """
+    CREATE TABLE IF NOT EXISTS token_slices (
+        slice_id INTEGER PRIMARY KEY,
+        matcher TEXT,
+        country_iso TEXT,
+        gazetteer_version TEXT,
+        UNIQUE(matcher, country_iso, gazetteer_version)
+    );
+    CREATE TABLE IF NOT EXISTS token_matches (
+        slice_id INTEGER,
+        token TEXT,
+        value TEXT,
+        PRIMARY KEY(slice_id, token)
+    ) WITHOUT ROWID;
+"""
+
+
+def gazetteer_version(db_path):
+    """Derive a version string for the geo DB from its size and modification time."""
+    st = os.stat(db_path)
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+class TokenClassificationCache:
+    def __init__(self, path, version, max_slices=64, flush_every=10_000):
+        self.version = version
+        self.max_slices = max_slices
+        self.flush_every = flush_every
+        self._slices: OrderedDict[tuple[str, str], dict[str, str | None]] = OrderedDict()
+        self._slice_ids: dict[tuple[str, str], int] = {}
+        self._pending = []
+        self._lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.executescript(schema)
+
+    def _slice_id(self, matcher, country_iso):
+        key = (matcher, country_iso)
+        if key not in self._slice_ids:
+            self.conn.execute("""
+                INSERT OR IGNORE INTO token_slices (matcher, country_iso, gazetteer_version)
+                VALUES (?, ?, ?);
+            """, (matcher, country_iso, self.version))
+            self._slice_ids[key] = self.conn.execute("""
+                SELECT slice_id FROM token_slices
+                WHERE matcher = ? AND country_iso = ? AND gazetteer_version = ?;
+            """, (matcher, country_iso, self.version)).fetchone()[0]
+        return self._slice_ids[key]
+
+    def _slice(self, matcher, country_iso):
+        """Return {token: value} of `matcher` for country_iso, loading it on first use."""
+        key = (matcher, country_iso)
+        entries = self._slices.get(key)
+        if entries is not None:
+            self._slices.move_to_end(key)
+            return entries
+        entries = dict(self.conn.execute(
+            "SELECT token, value FROM token_matches WHERE slice_id = ?;",
+            (self._slice_id(matcher, country_iso),)))
+        profiler.count("token_cache", "slice_loads")
+        self._slices[key] = entries
+        if len(self._slices) > self.max_slices:
+            self._slices.popitem(last=False)
+        return entries
+
+    def get_many(self, matcher, country_iso, tokens):
+        """
+        Return {token: value} for the tokens `matcher` has already classified;
+        value is None for tokens known not to match. Uncached tokens are left out.
+        """
+        with self._lock:
+            entries = self._slice(matcher, country_iso)
+        found = {token: entries[token] for token in tokens if token in entries}
+        profiler.count("token_cache", "hits", len(found))
+        profiler.count("token_cache", "misses", len(tokens) - len(found))
+        return found
+
+    def put_many(self, matcher, country_iso, results):
+        """Cache {token: value} classifications by `matcher` (value None for no match)."""
+        with self._lock:
+            self._slice(matcher, country_iso).update(results)
+            slice_id = self._slice_id(matcher, country_iso)
+            self._pending.extend((slice_id, token, value) for token, value in results.items())
+            if len(self._pending) >= self.flush_every:
+                self._flush()
+
+    def _flush(self):
+        if self._pending:
+            self.conn.executemany("""
+                INSERT OR REPLACE INTO token_matches (slice_id, token, value)
+                VALUES (?, ?, ?);
+            """, self._pending)
+            self.conn.commit()
+            self._pending = []
+
+    def flush(self):
+        with self._lock:
+            self._flush()
+
+    def close(self):
+        self.flush()
+        self.conn.close()
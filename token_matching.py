@@ -1,21 +1,27 @@
 import argparse
-import sys
 import re
+import sqlite3
+import sys
 import pandas as pd
-import gzip
-import json
-from collections import defaultdict, deque
+import zlib
+from collections import Counter, defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
 from difflib import get_close_matches
 
 
 from NaryTree import (NaryTree, MatchNode)
 from geoip_database import get_iso_country
 import load_geo_database as geo
-from NaryTreeVisualize import (generate_mermaid_tree, draw_tree, plot_tree_metrics)
-from NaryTreeComplexity import analyze_tree_complexity
+from NaryTreeVisualize import (draw_tree, plot_tree_metrics)
+# aggregate_digits_by_depth, match_type_of and tree_to_edges are re-exported from their old home
+from tree_export import (MATCHERS, combine_trees, aggregate_digits_by_depth, match_type_of, tree_to_edges,
+                         metrics_to_frame, TreeExporter)
+from pipeline_profiler import (profiler, profile_dump)
+from token_cache import (TokenClassificationCache, gazetteer_version)
+from columnar_io import (FORMATS, read_patterns, iter_pattern_chunks, iter_etldp1_partitions, write_table)
 
 
-MATCHERS = ["GEO-names", "UN-locode", "UN-subdiv", "directional", "GEO-classification"]
 
 def normalize_namefill_pattern(raw_pattern: str) -> str:
     def replacer(match):
@@ -42,14 +48,16 @@ def collect_tokens_by_level(tree_root):
             queue.append((child, depth + 1))
     return tokens_by_depth
 
-def match_geonames(tokens_by_depth, geo_names):
+def build_geonames_index(geo_names):
     reverse_index = {}
     for entry in geo_names:
         reverse_index['name'] = entry['ascii']
         if entry['alternates']:
             for alt in entry['alternates']:
                 reverse_index[alt] = entry['name']
+    return reverse_index
 
+def match_geonames(tokens_by_depth, reverse_index, label=None):
     matched = defaultdict(set)
     for depth, tokens in tokens_by_depth.items():
         for token in tokens:
@@ -67,6 +75,53 @@ def match_terms(tokens_by_depth, term_set, label):
                 matched[depth].add((stripped, stripped))
     return matched
 
+def cached_match(cache, match_type, country_iso, tokens_by_depth, load_terms, matcher):
+    """
+    Match tokens_by_depth with `matcher`, consulting the token classification cache first.
+    Terms are only loaded (via load_terms) and matched for tokens the cache doesn't know.
+    """
+    if cache is None:
+        with profiler.stage("load_gazetteer"):
+            terms = load_terms()
+        return matcher(tokens_by_depth, terms, match_type)
+
+    # directional/GEO-classification terms are global, so share their entries across countries
+    scope = "" if match_type in MATCHERS[3:] else country_iso
+    stripped = {token.strip('.-') for tokens in tokens_by_depth.values() for token in tokens}
+    known = cache.get_many(match_type, scope, stripped)
+    missing = stripped - known.keys()
+
+    if missing:
+        uncached = {
+            depth: {token for token in tokens if token.strip('.-') in missing}
+            for depth, tokens in tokens_by_depth.items()
+        }
+        with profiler.stage("load_gazetteer"):
+            terms = load_terms()
+        fresh = matcher(uncached, terms, match_type)
+        found = {m[0]: m[1] for matches in fresh.values() for m in matches}
+        computed = {token: found.get(token) for token in missing}
+        cache.put_many(match_type, scope, computed)
+        known.update(computed)
+
+    matched = defaultdict(set)
+    for depth, tokens in tokens_by_depth.items():
+        for token in tokens:
+            key = token.strip('.-')
+            if known.get(key) is not None:
+                matched[depth].add((key, known[key]))
+    return matched
+
+def record_matcher_hits(match_type, tokens_by_depth, matches_by_depth):
+    """Count checked and matched tokens for the profiler's per-matcher hit rates."""
+    checked = matched = 0
+    for depth, tokens in tokens_by_depth.items():
+        matched_keys = {m[0] for m in matches_by_depth.get(depth, ())}
+        checked += len(tokens)
+        matched += sum(1 for token in tokens if token.strip('.-') in matched_keys)
+    profiler.count("matcher_tokens_checked", match_type, checked)
+    profiler.count("matcher_tokens_matched", match_type, matched)
+
 def build_modified_tree(original_tree, matches_by_depth, match_type, aggregated=False):
     new_tree = NaryTree()
 
@@ -94,132 +149,231 @@ def build_modified_tree(original_tree, matches_by_depth, match_type, aggregated=
     return new_tree
 
 
-def combine_trees(target_tree, source_tree):
-    def dfs(t_node, s_node):
-        for label, s_child in s_node.children.items():
-            if label not in t_node.children:
-                t_node.children[label] = MatchNode(label)
-            t_node.children[label].values.update(s_child.values)
-            dfs(t_node.children[label], s_child)
-    dfs(target_tree.root, source_tree.root)
-   
-    return target_tree
-        
-
-def aggregate_digits_by_depth(tree):
-    new_tree = NaryTree()
-    
-    def dfs(orig_node, new_node, depth):
-        digit_children = {}
-        regular_children = {}
-        for label, child in orig_node.children.items():
-            token = label.strip('.-')
-            (digit_children if token.isdigit() else regular_children)[token] = child
-
-        if digit_children:
-            digit_values = list(map(int, digit_children.keys()))
-            label_range = f"digits@{depth}:[{min(digit_values)},{max(digit_values)}]for:{len(digit_values)}"
-            agg_node = new_node.children.setdefault(label_range, MatchNode(label_range))
-            for child in digit_children.values():
-                agg_node.values.update(child.values)
-                dfs(child, agg_node, depth + 1)
-
-        for label, child in regular_children.items():
-            next_node = new_node.children.setdefault(label, MatchNode(label))
-            next_node.values.update(child.values)
-            dfs(child, next_node, depth + 1)
-
-    dfs(tree.root, new_tree.root, 0)
-    return new_tree
-
-def load_and_match(plucked_trees, tree, etldp1, country_iso, conn, aggregated=False):
+def classify_tree(tree, country_iso, conn, aggregated=False, cache=None):
+    """Relabel the tokens of `tree` with every matcher and return the resulting tree; one connection per concurrent call."""
     c = conn.cursor()
     
     tokens = collect_tokens_by_level(tree.root)
 
+    # gazetteer terms are loaded lazily, only when some token is not in the cache
     matches_list = [
-        ("directional", geo.load_directional_terms(c), match_terms),
-        ("GEO-classification", geo.load_geo_classification_terms(c), match_terms),
-        ("UN-locode", set(x['locode'] for x in geo.load_un_locode(c, country_iso)), match_terms),
-        ("UN-subdiv", set(x['code'] for x in geo.load_un_locode_subdiv(c, country_iso)), match_terms),
-        ("GEO-names", geo.load_geo_names(c, country_iso), match_geonames)
+        ("directional", lambda: geo.load_directional_terms(c), match_terms),
+        ("GEO-classification", lambda: geo.load_geo_classification_terms(c), match_terms),
+        ("UN-locode", lambda: geo.load_un_locode_codes(c, country_iso), match_terms),
+        ("UN-subdiv", lambda: geo.load_un_locode_subdiv_codes(c, country_iso), match_terms),
+        ("GEO-names", lambda: build_geonames_index(geo.iter_geo_names(c, country_iso)), match_geonames)
     ]
     base_tree = tree
-    for match_type, term_set, matcher in matches_list:
-        match_result = matcher(tokens, term_set, match_type) if match_type != "GEO-names" else matcher(tokens, term_set)
+    for match_type, load_terms, matcher in matches_list:
+        with profiler.stage("match_tokens"):
+            match_result = cached_match(cache, match_type, country_iso, tokens, load_terms, matcher)
+        if profiler.enabled:
+            record_matcher_hits(match_type, tokens, match_result)
         if match_result:
             #print(f"{match_type} matches: {match_result}")
             label = f"{match_type}:{country_iso}" if match_type not in MATCHERS[3:] else f"{match_type}"
-            base_tree = build_modified_tree(base_tree, match_result, label, aggregated)
-    
-    if etldp1 in plucked_trees:
-        plucked_trees[etldp1] = combine_trees(plucked_trees[etldp1], base_tree)
-    else:
-        plucked_trees[etldp1] = base_tree
+            with profiler.stage("build_modified_tree"):
+                base_tree = build_modified_tree(base_tree, match_result, label, aggregated)
+    return base_tree
+
+
+def add_plucked_tree(plucked_trees, etldp1, base_tree, shared=False):
+    """Store `base_tree` as the plucked tree of etldp1, combining it with any tree already there."""
+    with profiler.stage("combine_trees"):
+        if etldp1 in plucked_trees:
+            plucked_trees[etldp1] = combine_trees(plucked_trees[etldp1], base_tree)
+        else:
+            plucked_trees[etldp1] = base_tree.to_shared() if shared else base_tree
+
+
+def load_and_match(plucked_trees, tree, etldp1, country_iso, conn, aggregated=False, shared=False, cache=None):
+    base_tree = classify_tree(tree, country_iso, conn, aggregated, cache)
+    add_plucked_tree(plucked_trees, etldp1, base_tree, shared)
 
 
 def main():
     parser = argparse.ArgumentParser(description="Classify DNS patterns using Geo DB")
-    parser.add_argument("input", nargs='?', type=argparse.FileType('r'), default=sys.stdin, help="Path to input pattern file")
+    parser.add_argument("input", nargs='?', default="-", help="Path to input pattern file ('|'-separated text, .parquet or .arrow; '-' for stdin)")
+    parser.add_argument("--input-format", default="auto", choices=FORMATS, help="Input format (auto detects from the file extension)")
     parser.add_argument("--geodb", default="geo_name_un_locode.db", help="Path to geo DB")
+    parser.add_argument("--geodb-immutable", action="store_true", help="Open the geo DB as immutable (no locking; the file must not change during the run)")
+    parser.add_argument("-j", "--workers", type=int, default=1, help="Number of threads classifying trees concurrently, each with a pooled read-only geo DB connection")
     parser.add_argument("--graph", default="normal", choices=["normal", "aggregated"], help="Graph aggregation option")
     parser.add_argument("-d", "--digits", action="store_true", help="Apply digits-aggregation")
     parser.add_argument("--export-json", type=str, help="Export all plucked trees as JSON files")
-    parser.add_argument("--export-metrics", type=str, help="Path to save tree complexity metrics as CSV")
+    parser.add_argument("--export-metrics", type=str, help="Path to save tree complexity metrics as CSV, .parquet or .arrow")
+    parser.add_argument("--export-edges", type=str, help="Path to save a flattened edge list of all plucked trees as CSV, .parquet or .arrow")
+    parser.add_argument("--stream", action="store_true", help="Read input in chunks, spill it to per-hash bucket files and process one eTLD+1 at a time, releasing its rows and trees once exported")
+    parser.add_argument("--stream-buckets", type=int, default=64, help="Number of bucket files --stream spills the input to")
+    parser.add_argument("--spill-dir", type=str, help="Directory for the --stream bucket files (default: the system temp directory)")
+    parser.add_argument("--shared-dag", action="store_true", help="Store plucked trees as hash-consed DAGs sharing identical subtrees")
+    parser.add_argument("--token-cache", type=str, help="Path to a persistent SQLite cache of token classifications")
+    parser.add_argument("--gazetteer-version", type=str, help="Gazetteer version for cache keys (default: derived from the geo DB file)")
+    parser.add_argument("--token-cache-slices", type=int, default=64, help="Per matcher and country slices of the token cache kept in memory (LRU)")
+    parser.add_argument("--shard", type=parse_shard, help="Only process the eTLD+1s of hash partition i out of N (i/N)")
+    parser.add_argument("--shard-output", type=str, help="Path to save mergeable partial trees and metrics (gzip JSON lines, see merge_shards.py)")
+    parser.add_argument("--profile", type=str, help="Path to save a JSON report of stage timings and pipeline counters")
+    parser.add_argument("--profile-dump", choices=["cprofile", "tracemalloc"], help="Also record a cProfile or tracemalloc dump")
+    parser.add_argument("--profile-dump-path", type=str, default="token_matching.prof", help="Path of the cProfile/tracemalloc dump")
     args = parser.parse_args()
+    if args.input == "-" and args.input_format in ("parquet", "arrow"):
+        parser.error(f"{args.input_format} input cannot be read from stdin, pass a file path")
 
-    df = pd.read_csv(args.input, sep='|', header=None, names=['patterntype', 'pattern', 'ip', 'etldp1', 'ipprefix', 'matchcount'])
-    df['pattern_clean'] = df['pattern'].apply(normalize_namefill_pattern)
-    df['country_iso'] = df['ip'].apply(get_iso_country)
+    if args.stream_buckets < 1:
+        parser.error("--stream-buckets must be at least 1")
 
+    profiler.enabled = bool(args.profile)
+    try:
+        with profile_dump(args.profile_dump, args.profile_dump_path):
+            with profiler.stage("total"):
+                run(args)
+    except (OSError, ValueError, sqlite3.Error) as e:
+        sys.exit(f"error: {e}")
+    if args.profile:
+        profiler.write_report(args.profile)
+
+def shard_of(etldp1, num_shards):
+    """Stable hash partition of an eTLD+1 (independent of the interpreter's hash seed)."""
+    return zlib.crc32(etldp1.encode('utf-8')) % num_shards
+
+def parse_shard(value):
+    """Parse an 'i/N' shard specification into (i, N)."""
+    try:
+        index, count = (int(part) for part in value.split('/'))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected i/N")
+    if count < 1 or not 0 <= index < count:
+        raise argparse.ArgumentTypeError(f"invalid shard {value!r}, expected 0 <= i < N")
+    return index, count
+
+def build_trees(df):
+    """Build one NaryTree per eTLD+1 and country; returns the trees and the number of rejected patterns."""
     country_nan_count = 0
-    trees, tree_complexity_metrics, plucked_trees, all_trees_dict = {}, {}, {}, {}
-    for _, row in df.iterrows():
-        pattern, etldp1, country_iso = row['pattern_clean'], row['etldp1'], row['country_iso']
-        if pd.notna(pattern) and pd.notna(etldp1) and pd.notna(country_iso):
-            try:
-                key = f"{etldp1}_{country_iso}"
-                trees.setdefault(key, NaryTree()).insert(pattern, etldp1)
-            except ValueError:
-                country_nan_count += 1
-                print(f"{etldp1}resolved to ISO:{country_iso}")
-
-    conn = geo.connect_geo_db(args.geodb)
-    for key, tree in trees.items():
+    trees = {}
+    with profiler.stage("build_trees"):
+        for _, row in df.iterrows():
+            pattern, etldp1, country_iso = row['pattern_clean'], row['etldp1'], row['country_iso']
+            if pd.notna(pattern) and pd.notna(etldp1) and pd.notna(country_iso):
+                try:
+                    key = f"{etldp1}_{country_iso}"
+                    created = trees.setdefault(key, NaryTree()).insert(pattern, etldp1)
+                    profiler.count("nodes_created", key, created)
+                except ValueError:
+                    country_nan_count += 1
+                    print(f"{etldp1}resolved to ISO:{country_iso}")
+    return trees, country_nan_count
+
+def classify_trees(trees, pool, args, cache=None):
+    """
+    Classify the country trees and combine them into one plucked tree per eTLD+1.
+    `trees` is emptied in the process.
+    With args.workers > 1 trees are classified concurrently, each worker borrowing
+    a connection from the pool; results are combined in input order.
+    """
+    aggregated = (args.graph == "aggregated")
+
+    def classify(key, tree):
         etldp1, country = key.split('_')
         print(f"\nAnalyzing: {etldp1} (Country: {country})")
-        load_and_match(plucked_trees, tree, etldp1, country, conn, aggregated=(args.graph == "aggregated"))
-    
-    # count the ambigous etldp1s
-    count_ambigous = 0
-    for etldp1, plucked_tree in plucked_trees.items():
-        if args.digits:
-            plucked_tree = aggregate_digits_by_depth(plucked_tree)
-        tree_complexity_metrics[etldp1] = analyze_tree_complexity(plucked_tree)
-        lines, _ = generate_mermaid_tree(plucked_tree.root, aggregated=(args.graph == "aggregated"))
-        
-        # store the trees/visualize and analyse
-        all_trees_dict[f"{etldp1}_tree"] = NaryTree.tree_to_dict(plucked_tree.root)
-
-        try:
-            with open(f"mermaid_trees/{etldp1}_plucked_tree.mmd", 'w') as f:
-                f.write("\n".join(lines))
-        except FileNotFoundError:
-            count_ambigous += 1
-            with open(f"ambigous_etldp1/{count_ambigous}_plucked_tree.mmd", 'w') as f:
-                f.write("\n".join(lines))
-
-    metrics_df = plot_tree_metrics(tree_complexity_metrics)
-    print(metrics_df.head())
-    print(metrics_df.describe())
-    print(f"total patterns: {sum(metrics_df.iloc[:,1])}")
-    print(f"Couldn't process {country_nan_count} patterns!")
-    if args.export_metrics:
-        metrics_df.to_csv(args.export_metrics)
-    if args.export_json:
-        with gzip.open(args.export_json, 'wt', encoding='utf-8') as f:
-            json.dump(all_trees_dict, f)
-    conn.close()
+        with pool.connection() as conn:
+            return etldp1, classify_tree(tree, country, conn, aggregated, cache)
+
+    # combine in plain form (in place) and convert an eTLD+1 to a shared DAG once
+    # its last country tree has been added
+    remaining = Counter(key.split('_')[0] for key in trees)
+    plucked_trees = {}
+
+    def add(etldp1, base_tree):
+        add_plucked_tree(plucked_trees, etldp1, base_tree)
+        remaining[etldp1] -= 1
+        if args.shared_dag and not remaining[etldp1]:
+            with profiler.stage("to_shared"):
+                plucked_trees[etldp1] = plucked_trees[etldp1].to_shared()
+
+    with profiler.stage("classify_trees"):
+        # raw trees are popped as they are classified so they can be freed
+        if args.workers > 1:
+            with ThreadPoolExecutor(max_workers=args.workers) as executor:
+                for etldp1, base_tree in executor.map(lambda key: classify(key, trees.pop(key)), list(trees)):
+                    add(etldp1, base_tree)
+        else:
+            for key in list(trees):
+                add(*classify(key, trees.pop(key)))
+    return plucked_trees
+
+def prepare_patterns(df):
+    """Add the normalized pattern and the GeoIP country of every row."""
+    with profiler.stage("normalize_patterns"):
+        df['pattern_clean'] = df['pattern'].apply(normalize_namefill_pattern)
+    with profiler.stage("geoip_lookup"):
+        df['country_iso'] = df['ip'].apply(get_iso_country).astype('category')
+    return df
+
+def run(args):
+    pool = geo.GeoDBPool(args.geodb, size=args.workers, immutable=args.geodb_immutable)
+    cache = None
+    exporter = None
+    try:
+        if args.token_cache:
+            version = args.gazetteer_version or gazetteer_version(args.geodb)
+            cache = TokenClassificationCache(args.token_cache, version, max_slices=args.token_cache_slices)
+        exporter = TreeExporter(args)
+
+        if args.stream:
+            # rows are spilled to per-hash bucket files and each eTLD+1 is handled on its own,
+            # so peak memory is bounded by one bucket's rows and one eTLD+1's trees
+            country_nan_count = 0
+            keep = None
+            if args.shard:
+                keep = lambda etldp1: shard_of(etldp1, args.shard[1]) == args.shard[0]
+            chunks = iter_pattern_chunks(args.input, args.input_format)
+            partitions = iter_etldp1_partitions(chunks, args.stream_buckets, keep, args.spill_dir)
+            with closing(partitions):
+                for etldp1, group in partitions:
+                    trees, rejected = build_trees(prepare_patterns(group))
+                    del group
+                    country_nan_count += rejected
+                    plucked_trees = classify_trees(trees, pool, args, cache)
+                    del trees
+                    for etldp1 in list(plucked_trees):
+                        exporter.export(etldp1, plucked_trees.pop(etldp1))
+        else:
+            with profiler.stage("read_input"):
+                df = read_patterns(args.input, args.input_format)
+            if args.shard:
+                index, count = args.shard
+                with profiler.stage("shard_filter"):
+                    in_shard = [e for e in df['etldp1'].cat.categories if shard_of(e, count) == index]
+                    df = df[df['etldp1'].isin(in_shard)].copy()
+            trees, country_nan_count = build_trees(prepare_patterns(df))
+            plucked_trees = classify_trees(trees, pool, args, cache)
+            for etldp1, plucked_tree in plucked_trees.items():
+                exporter.export(etldp1, plucked_tree)
+
+        with profiler.stage("export"):
+            exporter.close()
+
+        if not exporter.tree_complexity_metrics:
+            # e.g. a shard without eTLD+1s: nothing to plot or summarize
+            print("no trees to analyze")
+            metrics_df = metrics_to_frame({})
+        else:
+            with profiler.stage("plot_metrics"):
+                metrics_df = plot_tree_metrics(exporter.tree_complexity_metrics)
+            print(metrics_df.head())
+            print(metrics_df.describe())
+            print(f"total patterns: {sum(metrics_df.iloc[:,1])}")
+        print(f"Couldn't process {country_nan_count} patterns!")
+        if args.export_metrics:
+            with profiler.stage("export"):
+                write_table(metrics_df, args.export_metrics)
+    finally:
+        # also on errors, so the exports are left readable and the connections closed
+        if exporter:
+            exporter.close()
+        if cache:
+            cache.close()
+        pool.close()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,247 @@
+import gzip
+import json
+import pandas as pd
+
+from NaryTree import (NaryTree, MatchNode, NodeInterner)
+from NaryTreeComplexity import (analyze_tree_complexity, count_total_nodes, count_unique_nodes)
+from pipeline_profiler import profiler
+from columnar_io import EdgeTableWriter
+
+
+"""
+Tree Export:
+Combining and finalizing plucked trees: combine_trees, digit aggregation,
+Mermaid and edge-list flattening, and the TreeExporter used by token_matching.py
+and merge_shards.py. Does no GeoIP or plotting work, so it can be imported
+on hosts that only merge results.
+"""
+
+MATCHERS = ["GEO-names", "UN-locode", "UN-subdiv", "directional", "GEO-classification"]
+
+def combine_trees(target_tree, source_tree):
+    if target_tree.is_shared:
+        # shared nodes are immutable, so merge into new interned nodes instead
+        target_tree.root = NodeInterner().merge(target_tree.root, source_tree.root, merge_values=False)
+        return target_tree
+
+    def dfs(t_node, s_node):
+        for label, s_child in s_node.children.items():
+            if label not in t_node.children:
+                t_node.children[label] = MatchNode(label)
+            t_node.children[label].values.update(s_child.values)
+            dfs(t_node.children[label], s_child)
+    dfs(target_tree.root, source_tree.root)
+   
+    return target_tree
+
+def aggregate_digits_by_depth(tree):
+    if tree.is_shared:
+        return _aggregate_digits_shared(tree)
+
+    new_tree = NaryTree()
+    
+    def dfs(orig_node, new_node, depth):
+        digit_children = {}
+        regular_children = {}
+        for label, child in orig_node.children.items():
+            token = label.strip('.-')
+            (digit_children if token.isdigit() else regular_children)[token] = child
+
+        if digit_children:
+            digit_values = list(map(int, digit_children.keys()))
+            label_range = f"digits@{depth}:[{min(digit_values)},{max(digit_values)}]for:{len(digit_values)}"
+            agg_node = new_node.children.setdefault(label_range, MatchNode(label_range))
+            for child in digit_children.values():
+                agg_node.values.update(child.values)
+                dfs(child, agg_node, depth + 1)
+
+        for label, child in regular_children.items():
+            next_node = new_node.children.setdefault(label, MatchNode(label))
+            next_node.values.update(child.values)
+            dfs(child, next_node, depth + 1)
+
+    dfs(tree.root, new_tree.root, 0)
+    return new_tree
+
+def _aggregate_digits_shared(tree):
+    """
+    aggregate_digits_by_depth for shared (DAG) trees: each (node, depth) is aggregated
+    once and the result is built from interned nodes, so it stays in shared form.
+    Digit siblings are combined with merge(), which unions values and children
+    exactly like the in-place aggregation does.
+    """
+    interner = NodeInterner()
+    new_tree = NaryTree()
+    children = _aggregate_shared_children(tree.root, 0, interner, {})
+    new_tree.root = interner.make(new_tree.root.label, (), children)
+    new_tree.is_shared = True
+    return new_tree
+
+def _aggregate_shared_children(orig_node, depth, interner, memo):
+    # module-level rather than a recursive closure, so the interner and memo are
+    # freed as soon as the aggregation returns instead of waiting for the gc
+    key = (id(orig_node), depth)
+    if key in memo:
+        return memo[key]
+    digit_children = {}
+    regular_children = {}
+    for label, child in orig_node.children.items():
+        token = label.strip('.-')
+        (digit_children if token.isdigit() else regular_children)[token] = child
+
+    children = {}
+    if digit_children:
+        digit_values = list(map(int, digit_children.keys()))
+        label_range = f"digits@{depth}:[{min(digit_values)},{max(digit_values)}]for:{len(digit_values)}"
+        agg_node = None
+        for child in digit_children.values():
+            grandchildren = _aggregate_shared_children(child, depth + 1, interner, memo)
+            node = interner.make(label_range, child.values, grandchildren)
+            agg_node = node if agg_node is None else interner.merge(agg_node, node)
+        children[label_range] = agg_node
+
+    for label, child in regular_children.items():
+        grandchildren = _aggregate_shared_children(child, depth + 1, interner, memo)
+        children[label] = interner.make(label, child.values, grandchildren)
+
+    memo[key] = children
+    return children
+
+def match_type_of(label):
+    """Return the matcher type encoded in a classified label, 'digits' for digit aggregates, else None."""
+    prefix = label.split(':', 1)[0]
+    if prefix in MATCHERS:
+        return prefix
+    if label.startswith("digits@"):
+        return "digits"
+    return None
+
+def tree_to_edges(etldp1, tree):
+    """
+    Flatten a classified tree into edge-list rows (see columnar_io.EDGE_COLUMNS).
+    Nodes are numbered per tree (the root is 0), so (etldp1, node_id) identifies a node
+    and parent_id links it to its parent; shared subtrees get an id per occurrence.
+    """
+    rows = []
+    next_id = 1
+    stack = [(tree.root, 0, 0)]
+    while stack:
+        node, node_id, depth = stack.pop()
+        for label, child in node.children.items():
+            rows.append((etldp1, next_id, node_id, depth, node.label, label, match_type_of(label), len(child.values)))
+            stack.append((child, next_id, depth + 1))
+            next_id += 1
+    return rows
+
+def generate_mermaid_tree(node, parent_label=None, lines=None, node_id=0, aggregated=False):
+    if lines is None:
+        lines = ["flowchart TD"]
+    node_values = list(node.values)
+    
+    if aggregated and node_values:
+        examples = ', '.join(node_values[:3])
+        node_label = f"{node.label} .i.e. {examples}".replace('"', "'")  # Escape quotes
+    else:
+        node_label = f"{node.label}".replace('"', "'")
+
+    current_id = f"n{node_id}"
+    lines.append(f'{current_id}["{node_label}"]')
+
+    if parent_label is not None:
+        lines.append(f"{parent_label} --> {current_id}")
+
+    this_id = current_id
+    child_id = node_id + 1
+
+    for child in node.children.values():
+        lines, child_id = generate_mermaid_tree(child, this_id, lines, child_id, aggregated=True)
+
+    return lines, child_id
+
+def metrics_to_frame(metrics_dict):
+    df = pd.DataFrame(metrics_dict).T.reset_index()
+    return df.rename(columns={"index": "etldp1"})
+
+class TreeExporter:
+    """
+    Finalizes plucked trees one at a time: digit aggregation, complexity metrics,
+    Mermaid, edge-list and JSON export. JSON is streamed into the gzip file so
+    nothing but the metrics is retained once a tree has been exported.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.aggregated = (args.graph == "aggregated")
+        self.tree_complexity_metrics = {}
+        # count the ambigous etldp1s
+        self.count_ambigous = 0
+        self.edge_writer = EdgeTableWriter(args.export_edges) if args.export_edges else None
+        self.json_file = gzip.open(args.export_json, 'wt', encoding='utf-8') if args.export_json else None
+        self._json_entries = 0
+        if self.json_file:
+            self.json_file.write("{")
+        self.partial_file = None
+        if args.shard_output:
+            self.partial_file = gzip.open(args.shard_output, 'wt', encoding='utf-8')
+            self.partial_file.write(json.dumps({
+                "shard": args.shard and f"{args.shard[0]}/{args.shard[1]}",
+                "graph": args.graph,
+                "digits": args.digits,
+            }) + "\n")
+
+    def export(self, etldp1, plucked_tree, metrics=None):
+        """Finalize one plucked tree; precomputed `metrics` skip the complexity analysis."""
+        raw_tree = plucked_tree
+        if self.args.digits:
+            with profiler.stage("aggregate_digits"):
+                plucked_tree = aggregate_digits_by_depth(plucked_tree)
+        if profiler.enabled:
+            profiler.count("classified_tree_nodes", etldp1, count_total_nodes(plucked_tree))
+            profiler.count("classified_tree_unique_nodes", etldp1, count_unique_nodes(plucked_tree))
+        if metrics is None:
+            with profiler.stage("tree_metrics"):
+                metrics = analyze_tree_complexity(plucked_tree)
+        self.tree_complexity_metrics[etldp1] = metrics
+        if self.partial_file:
+            # partial outputs keep the tree before digit aggregation so they can be combined
+            with profiler.stage("shard_export"):
+                self.partial_file.write(json.dumps({
+                    "etldp1": etldp1,
+                    "tree": NaryTree.tree_to_dict(raw_tree.root),
+                    "metrics": metrics,
+                }) + "\n")
+        with profiler.stage("mermaid_export"):
+            lines, _ = generate_mermaid_tree(plucked_tree.root, aggregated=self.aggregated)
+        
+        # store the trees/visualize and analyse
+        if self.json_file:
+            with profiler.stage("tree_to_dict"):
+                if self._json_entries:
+                    self.json_file.write(", ")
+                self.json_file.write(f"{json.dumps(f'{etldp1}_tree')}: ")
+                json.dump(NaryTree.tree_to_dict(plucked_tree.root), self.json_file)
+                self._json_entries += 1
+        if self.edge_writer:
+            with profiler.stage("edge_export"):
+                self.edge_writer.write(tree_to_edges(etldp1, plucked_tree))
+
+        with profiler.stage("mermaid_export"):
+            try:
+                with open(f"mermaid_trees/{etldp1}_plucked_tree.mmd", 'w') as f:
+                    f.write("\n".join(lines))
+            except FileNotFoundError:
+                self.count_ambigous += 1
+                with open(f"ambigous_etldp1/{self.count_ambigous}_plucked_tree.mmd", 'w') as f:
+                    f.write("\n".join(lines))
+
+    def close(self):
+        """Finish the export files; safe to call more than once."""
+        if self.edge_writer:
+            self.edge_writer.close()
+            self.edge_writer = None
+        if self.json_file:
+            self.json_file.write("}")
+            self.json_file.close()
+            self.json_file = None
+        if self.partial_file:
+            self.partial_file.close()
+            self.partial_file = None